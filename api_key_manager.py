@@ -1,18 +1,41 @@
+import atexit
 import json
-from itertools import cycle
+import os
+import threading
+from itertools import count
 
 class APIKeyManager:
-    def __init__(self, keys_file):
+    def __init__(self, keys_file, cursor_file=".keycursor.json", flush_every=100):
         """
         Initialize the APIKeyManager with a JSON file containing faction IDs and their API keys.
         :param keys_file: Path to the JSON file with faction IDs and keys.
+        :param cursor_file: Path to the JSON file where the next key index per faction is saved between runs.
+        :param flush_every: Save the key indexes to `cursor_file` after this many calls to get_next_key.
         """
         self.keys_file = keys_file
+        self.cursor_file = cursor_file
+        self.flush_every = flush_every
         self.faction_keys = {}
-        self.key_cycles = {}
+        self.keys = {}
+        self.counters = {}
+        self.cursors = {}
+        # Saved cursors for factions missing from the keys file, written back unchanged
+        self.other_cursors = {}
+        self.call_counter = count(1)
+        # Only taken by flush, which is off the get_next_key hot path
+        self.flush_lock = threading.Lock()
 
-        # Load the keys from the file
+        # Load the keys from the file and resume each faction's rotation where the last run stopped
         self._load_keys()
+        self._load_cursors()
+
+        # next() on itertools.count is atomic, so threads can share a counter without a lock
+        for faction_id, index in self.cursors.items():
+            self.counters[faction_id] = count(index)
+
+        # Save the key indexes when the script exits, unless no keys loaded and there is nothing to save
+        if self.keys:
+            atexit.register(self.flush)
 
     def _load_keys(self):
         """
@@ -21,19 +44,63 @@ class APIKeyManager:
         try:
             with open(self.keys_file, "r") as f:
                 self.faction_keys = json.load(f)
-            
-            # Create a cycle iterator for each faction's keys
+
+            # Keep a tuple of keys and the index of the next key for each faction
             for faction_id, data in self.faction_keys.items():
-                self.key_cycles[faction_id] = cycle(data["keys"])
+                self.keys[faction_id] = tuple(data["keys"])
+                self.cursors[faction_id] = 0
         except Exception as e:
             print(f"[ERROR] Failed to load API keys: {e}")
 
+    def _load_cursors(self):
+        """
+        Load the saved key index for each faction from the cursor file, if it exists.
+        """
+        if not os.path.exists(self.cursor_file):
+            return
+        try:
+            with open(self.cursor_file, "r") as f:
+                saved_cursors = json.load(f)
+            for faction_id, index in saved_cursors.items():
+                if faction_id in self.cursors:
+                    self.cursors[faction_id] = int(index)
+                else:
+                    self.other_cursors[faction_id] = index
+        except Exception as e:
+            print(f"[ERROR] Failed to load API key cursors: {e}")
+
+    def flush(self):
+        """
+        Atomically save the next key index for each faction to the cursor file.
+        The lock keeps overlapping flushes (from worker threads or atexit) from sharing the temp file.
+        Does nothing if no keys were loaded, so a bad read of the keys file can't wipe the saved cursors.
+        """
+        if not self.keys:
+            return
+        temp_file = f"{self.cursor_file}.tmp"
+        with self.flush_lock:
+            cursors = dict(self.other_cursors)
+            cursors.update({faction_id: index % len(self.keys[faction_id]) for faction_id, index in self.cursors.items() if self.keys[faction_id]})
+            try:
+                with open(temp_file, "w") as f:
+                    json.dump(cursors, f)
+                os.replace(temp_file, self.cursor_file)
+            except Exception as e:
+                print(f"[ERROR] Failed to save API key cursors: {e}")
+
     def get_next_key(self, faction_id):
         """
         Get the next API key for a given faction ID.
         :param faction_id: The faction ID for which to retrieve the next API key.
         :return: The next API key as a string.
         """
-        if faction_id not in self.key_cycles:
+        if faction_id not in self.counters:
             raise ValueError(f"Faction ID {faction_id} not found in the keys file.")
-        return next(self.key_cycles[faction_id])
\ No newline at end of file
+        keys = self.keys[faction_id]
+        index = next(self.counters[faction_id])
+        # Only used for saving, so a slightly stale value under contention is harmless
+        self.cursors[faction_id] = index + 1
+
+        if next(self.call_counter) % self.flush_every == 0:
+            self.flush()
+        return keys[index % len(keys)]
@@ -1,12 +1,20 @@
 import requests
-import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import orjson
+import ijson
 import csv
 from datetime import datetime
 from dotenv import load_dotenv
 import os
-import threading
+import sys
+import logging
+from logging.handlers import QueueHandler, QueueListener
 import time
 from queue import Queue
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from personal_stats import eggs
+from rate_limiter import TokenBucket, backoff_delay, get_retry_after
 
 # Load environment variables from a .env file
 load_dotenv()
@@ -15,6 +23,43 @@ load_dotenv()
 API_KEY = os.getenv("APIKEY")
 BASE_URL = "https://api.torn.com/v2"
 
+# Worker log messages are queued and written by a single listener thread, so workers never wait on stdout
+log_queue = Queue(-1)
+log_handler = logging.StreamHandler(sys.stdout)
+log_handler.setFormatter(logging.Formatter("[%(levelname)s] %(message)s"))
+log_listener = QueueListener(log_queue, log_handler)
+log_listener.start()
+logging.getLogger().addHandler(QueueHandler(log_queue))
+logging.getLogger().setLevel(logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Number of members shown in the Discord results
+DISCORD_TOP_N = 20
+
+# Number of worker threads used to fetch personal stats
+num_threads = 14  # Adjust based on your system and API limits
+
+# Shared HTTP session so connections to the Torn API are reused across requests.
+# 5xx responses are retried by the adapter with jittered backoff; 429 is left to fetch_one so
+# rate-limit retries wait on the token bucket instead of bypassing it.
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=num_threads,
+    pool_maxsize=num_threads,
+    max_retries=Retry(
+        total=5,
+        backoff_factor=0.5,
+        backoff_jitter=0.5,
+        status_forcelist=(500, 502, 503, 504),
+        respect_retry_after_header=True,
+    ),
+))
+# Ask for compressed responses on a kept-alive connection; bodies are decoded from bytes with orjson
+SESSION.headers.update({"Accept-Encoding": "gzip, deflate", "Connection": "keep-alive"})
+
+# Rate limiter for the API key (100 calls per minute)
+bucket = TokenBucket(rate_per_min=100)
+
 # Generate a unique filename with a timestamp for the final stats
 timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
 output_file = f"faction_personalstats_{timestamp}.json"
@@ -24,14 +69,15 @@ def fetch_faction_members():
     print("[INFO] Fetching faction members...")
     url = f"{BASE_URL}/faction/members"
     params = {"key": API_KEY}
-    response = requests.get(url, params=params)
+    bucket.acquire()
+    response = SESSION.get(url, params=params, timeout=10)
     if response.status_code == 200:
-        data = response.json()
+        data = orjson.loads(response.content)
         if "members" in data:
             print("[INFO] Faction members fetched successfully.")
             # Save to JSON file
-            with open("members.json", "w") as f:
-                json.dump(data, f, indent=4)
+            with open("members.json", "wb") as f:
+                f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
             return {str(member["id"]): member.get("name", "Unknown") for member in data["members"]}
         else:
             print("[ERROR] Failed to retrieve faction members.")
@@ -40,92 +86,88 @@ def fetch_faction_members():
         print(f"[ERROR] Failed to fetch faction members: {response.status_code}")
         return {}
 
-# Thread-safe queue for member IDs
-member_queue = Queue()
-results_lock = threading.Lock()
-all_personal_stats = {}
-
-# Function to fetch personal stats for a user (thread worker)
-def fetch_personal_stats_worker():
-    while not member_queue.empty():
-        member_id = member_queue.get()
-        url = f"{BASE_URL}/user/{member_id}/personalstats"
-        params = {"key": API_KEY, "cat": "all"}
+# Function to fetch personal stats for a user (runs in the thread pool)
+def fetch_one(member_id):
+    """
+    Fetch the personal stats for a single user, retrying while the API reports a rate limit.
+    :param member_id: The ID of the user to fetch stats for.
+    :return: The personal stats dictionary, or None if the fetch failed.
+    """
+    url = f"{BASE_URL}/user/{member_id}/personalstats"
+    # Only request the easter egg stat; eggs() parses the narrower response
+    params = {"key": API_KEY, "stat": "eastereggsfound"}
+    rate_limit_attempt = 0
+    while True:
         try:
-            response = requests.get(url, params=params)
-            if response.status_code == 200:
-                stats = response.json()
-                with results_lock:
-                    all_personal_stats[member_id] = stats
-                print(f"[INFO] Fetched stats for member {member_id}.")
-            else:
-                print(f"[ERROR] Failed to fetch data for user {member_id}: {response.status_code}")
+            bucket.acquire()
+            response = SESSION.get(url, params=params, timeout=10)
+            stats = orjson.loads(response.content) if response.status_code == 200 else None
+            if response.status_code == 429 or (stats is not None and "error" in stats and stats["error"]["code"] == 5):
+                # Too many requests, either as HTTP 429 or as Torn's error code 5 sent with HTTP 200
+                retry_after = get_retry_after(response.headers, backoff_delay(rate_limit_attempt))
+                rate_limit_attempt += 1
+                logger.warning("Too many requests for user %s. Retrying after %.1f seconds...", member_id, retry_after)
+                bucket.pause_until(time.monotonic() + retry_after)
+                continue
+            if response.status_code != 200:
+                logger.error("Failed to fetch data for user %s: %s", member_id, response.status_code)
+                return None
+            logger.info("Fetched stats for member %s.", member_id)
+            return stats
         except Exception as e:
-            print(f"[ERROR] Error fetching data for user {member_id}: {e}")
-        finally:
-            member_queue.task_done()
-        time.sleep(0.6)  # Respect API rate limit (100 calls per minute)
+            logger.error("Error fetching data for user %s: %s", member_id, e)
+            return None
 
 # Fetch faction members only if members.json doesn't already exist
 if not os.path.exists("members.json"):
     member_names = fetch_faction_members()
 else:
     print("[INFO] members.json already exists. Loading faction members from file...")
-    with open("members.json", "r") as f:
-        data = json.load(f)
+    with open("members.json", "rb") as f:
+        data = orjson.loads(f.read())
         member_names = {str(member["id"]): member.get("name", "Unknown") for member in data.get("members", [])}
 
-# Add member IDs to the queue
-print("[INFO] Adding member IDs to the queue...")
-for member_id in member_names.keys():
-    member_queue.put(member_id)
-
-# Create and start threads
+# Fetch personal stats for every member in a thread pool; results are collected in the main thread
 print("[INFO] Starting threads to fetch personal stats...")
-num_threads = 14  # Adjust based on your system and API limits
-threads = []
-for _ in range(num_threads):
-    thread = threading.Thread(target=fetch_personal_stats_worker)
-    thread.start()
-    threads.append(thread)
-
-# Wait for all threads to finish
-for thread in threads:
-    thread.join()
+all_personal_stats = {}
+try:
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        futures = {executor.submit(fetch_one, member_id): member_id for member_id in member_names}
+        for future in as_completed(futures):
+            stats = future.result()
+            if stats is not None:
+                all_personal_stats[futures[future]] = stats
+finally:
+    # Flush any queued worker log messages before printing anything else, even if the fetch failed
+    log_listener.stop()
 
 print("[INFO] All threads have finished fetching personal stats.")
 
 # Save the new stats to a JSON file
-with open(output_file, "w") as f:
-    json.dump(all_personal_stats, f, indent=4)
+with open(output_file, "wb") as f:
+    f.write(orjson.dumps(all_personal_stats, option=orjson.OPT_INDENT_2))
 
 print(f"[INFO] Data saved to {output_file}")
 
-# Load the original and new data
+# Flatten the original and new data into {member_id: easter_eggs}; the original data is streamed one member at a time
 print("[INFO] Loading original and new data...")
-with open("faction_personalstats_OG.json", "r") as file:
-    original_data = json.load(file)
-
-with open(output_file, "r") as file:
-    new_data = json.load(file)
+with open("faction_personalstats_OG.json", "rb") as file:
+    original_eggs = {member_id: eggs(stats) for member_id, stats in ijson.kvitems(file, "")}
+new_eggs = {member_id: eggs(stats) for member_id, stats in all_personal_stats.items()}
 
 # Calculate the difference in easter eggs found for each member
 print("[INFO] Calculating differences in easter eggs found...")
-egg_differences = []
-
-for member_id, original_stats in original_data.items():
-    original_eggs = original_stats.get("personalstats", {}).get("items", {}).get("found", {}).get("easter_eggs", 0)
-    new_eggs = new_data.get(member_id, {}).get("personalstats", {}).get("items", {}).get("found", {}).get("easter_eggs", 0)
-    difference = new_eggs - original_eggs
-    member_name = member_names.get(member_id, "Unknown")
-    egg_differences.append((member_name, difference))
+egg_differences = [
+    (member_names.get(member_id, "Unknown"), new_eggs.get(member_id, 0) - count)
+    for member_id, count in original_eggs.items()
+]
 
 # Sort the results from most found to least found
 sorted_egg_differences = sorted(egg_differences, key=lambda x: x[1], reverse=True)
 
 # Save the results to a CSV file
 print("[INFO] Saving results to CSV file...")
-with open("egg_hunt_results.csv", "w", newline="") as csvfile:
+with open("egg_hunt_results.csv", "w", newline="", buffering=1 << 20) as csvfile:
     csvwriter = csv.writer(csvfile)
     csvwriter.writerow(["Member Name", "Eggs Found This Year"])  # Header row
     csvwriter.writerows(sorted_egg_differences)  # Data rows
@@ -135,10 +177,10 @@ print("[INFO] Results saved to egg_hunt_results.csv")
 # Print the results formatted for Discord
 print("[INFO] Printing results formatted for Discord...")
 print("```")
-print("Egg Hunt Results:")
+print(f"Egg Hunt Results (Top {DISCORD_TOP_N}):")
 print("Member Name                | Eggs Found This Year")
 print("-----------------------------------------------")
-for member_name, difference in sorted_egg_differences:
+for member_name, difference in sorted_egg_differences[:DISCORD_TOP_N]:
     print(f"{member_name:<25} | {difference}")
 print("```")
 print("[INFO] Script execution completed.")
\ No newline at end of file
@@ -1,13 +1,23 @@
-import requests
-import json
+import aiohttp
+import asyncio
+import orjson
+import ijson
 import csv
-from datetime import datetime
+import heapq
+from datetime import date, datetime
 from dotenv import load_dotenv
+import glob
 import os
+import sys
+import logging
+from logging.handlers import QueueHandler, QueueListener
+import shutil
 import threading
 import time
 from queue import Queue
 from api_key_manager import APIKeyManager  # Import the APIKeyManager
+from personal_stats import eggs
+from rate_limiter import TokenBucket, backoff_delay, get_retry_after
 
 # Load environment variables from a .env file
 load_dotenv()
@@ -15,160 +25,316 @@ load_dotenv()
 # Base URL for Torn API
 BASE_URL = "https://api.torn.com/v2"
 
+# Log messages are queued and written by a single listener thread, so workers never wait on stdout
+log_queue = Queue(-1)
+log_handler = logging.StreamHandler(sys.stdout)
+log_handler.setFormatter(logging.Formatter("[%(levelname)s] %(message)s"))
+log_listener = QueueListener(log_queue, log_handler)
+log_listener.start()
+logging.getLogger().addHandler(QueueHandler(log_queue))
+logging.getLogger().setLevel(logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Maximum number of in-flight requests per faction
+max_concurrency = 14  # Adjust based on your system and API limits
+
+# Connection pool and timeout settings for the shared aiohttp session
+CONNECTOR_LIMIT_PER_HOST = 64
+KEEPALIVE_TIMEOUT = 75
+REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=10)
+REQUEST_HEADERS = {"Accept-Encoding": "gzip, deflate", "Connection": "keep-alive"}
+
+# Torn API rate limit for each API key (requests per minute)
+RATE_LIMIT_PER_KEY = 100
+
+# Retry settings for failed HTTP requests
+MAX_RETRIES = 5
+BACKOFF_FACTOR = 0.5
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
 # Output file name
 output_file = f"user_profile_data.json"
 
+# Daily copy of the output file, reused instead of hitting the API when it is recent enough
+cache_file = f"user_profile_data_{date.today().isoformat()}.json"
+CACHE_MAX_AGE = 3600  # Seconds
+
+# Timestamp for January 1st of the current year; the totals at this point never change during the year,
+# so they are cached between runs
+current_year = datetime.now().year
+jan_1_timestamp = int(datetime(current_year, 1, 1).timestamp())
+previous_totals_file = f"previous_totals_{current_year}.json"
+
 # Initialize the APIKeyManager with the JSON file
 key_manager = APIKeyManager("faction_keys.json")
 
-# Thread-safe queue for member IDs
-member_queue = Queue()
-results_lock = threading.Lock()
-all_personal_stats = {}
+class RateLimitError(Exception):
+    """
+    Raised when the Torn API reports a "Too many requests" error (code 5).
+    `retry_after` is the Retry-After header value in seconds, or None if the response had none.
+    """
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+# Function to GET a Torn API endpoint with retries
+async def fetch_json(session, bucket, url, params):
+    """
+    GET a Torn API endpoint and decode the JSON response.
+    Waits for a token from the faction's rate limiter before each attempt, and retries HTTP 429/5xx
+    responses and connection errors with jittered exponential backoff, honouring any Retry-After header.
+    :param session: The shared aiohttp ClientSession.
+    :param bucket: The TokenBucket for the faction whose API key is used.
+    :param url: The URL to request.
+    :param params: The query parameters for the request.
+    :return: A tuple of (status code, decoded JSON or None).
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        await bucket.acquire_async()
+        try:
+            async with session.get(url, params=params) as response:
+                if response.status in RETRY_STATUSES and attempt < MAX_RETRIES:
+                    delay = get_retry_after(response.headers, backoff_delay(attempt, BACKOFF_FACTOR))
+                    if response.status == 429:
+                        # Hold back every request using this faction's keys, not just this one
+                        bucket.pause_until(time.monotonic() + delay)
+                    else:
+                        await asyncio.sleep(delay)
+                    continue
+                if response.status != 200:
+                    return response.status, None
+                data = orjson.loads(await response.read())
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            if attempt == MAX_RETRIES:
+                raise
+            await asyncio.sleep(backoff_delay(attempt, BACKOFF_FACTOR))
+            continue
+
+        if "error" in data and data["error"]["code"] == 5:
+            # Too many requests error
+            raise RateLimitError(data["error"].get("error", "Too many requests"), get_retry_after(response.headers))
+        return response.status, data
 
 # Function to fetch faction members
-def fetch_faction_members(faction_id):
+async def fetch_faction_members(session, bucket, faction_id):
     """
     Fetch members of a faction using the Torn API.
+    :param session: The shared aiohttp ClientSession.
+    :param bucket: The TokenBucket for the faction.
     :param faction_id: The ID of the faction to fetch members for.
     :return: A dictionary of member IDs and their names.
     """
-    print(f"[INFO] Fetching faction members for faction {faction_id}...")
+    logger.info("Fetching faction members for faction %s...", faction_id)
     api_key = key_manager.get_next_key(faction_id)
     url = f"{BASE_URL}/faction/{faction_id}/members"
     params = {"key": api_key}
-    response = requests.get(url, params=params)
-    if response.status_code == 200:
-        data = response.json()
+    rate_limit_attempt = 0
+    while True:
+        try:
+            status, data = await fetch_json(session, bucket, url, params)
+            break
+        except RateLimitError as e:
+            retry_after = e.retry_after if e.retry_after is not None else backoff_delay(rate_limit_attempt, BACKOFF_FACTOR)
+            rate_limit_attempt += 1
+            logger.warning("Too many requests for faction %s. Retrying after %.1f seconds...", faction_id, retry_after)
+            bucket.pause_until(time.monotonic() + retry_after)
+    if status == 200:
         if "members" in data:
-            print(f"[INFO] Faction members fetched successfully for faction {faction_id}.")
+            logger.info("Faction members fetched successfully for faction %s.", faction_id)
             return {str(member["id"]): member.get("name", "Unknown") for member in data["members"]}
         else:
-            print(f"[ERROR] Failed to retrieve faction members for faction {faction_id}.")
+            logger.error("Failed to retrieve faction members for faction %s.", faction_id)
             return {}
     else:
-        print(f"[ERROR] Failed to fetch faction members for faction {faction_id}: {response.status_code}")
+        logger.error("Failed to fetch faction members for faction %s: %s", faction_id, status)
         return {}
 
-# Function to fetch personal stats for a user (thread worker)
-def fetch_personal_stats_worker(faction_id, faction_name, members):
+# Function to fetch personal stats for a single user
+async def fetch_member(session, sem, bucket, faction_id, faction_name, member_id, members, previous_totals):
     """
-    Worker function to fetch personal stats for a user.
+    Fetch the Easter egg stats for a single user.
+    :param session: The shared aiohttp ClientSession.
+    :param sem: The semaphore limiting concurrent requests for the user's faction.
+    :param bucket: The TokenBucket for the user's faction.
     :param faction_id: The ID of the faction the user belongs to.
     :param faction_name: The name of the faction the user belongs to.
+    :param member_id: The ID of the user to fetch stats for.
     :param members: A dictionary mapping member IDs to their names.
+    :param previous_totals: A dictionary of cached January 1st totals keyed by member ID, updated in place.
+    :return: A tuple of (member ID, stats dictionary), or None if either lookup failed.
     """
-    while not member_queue.empty():
-        member_id = member_queue.get()
-        api_key = key_manager.get_next_key(faction_id)
-        base_url = f"{BASE_URL}/user/{member_id}/personalstats"
-        try:
-            # Get the timestamp for January 1st of the current year
-            current_year = datetime.now().year
-            jan_1_timestamp = int(datetime(current_year, 1, 1).timestamp())
-
-            # Fetch stats with the timestamp (previous year's total)
-            params_with_timestamp = {"key": api_key, "stat": "eastereggsfound", "timestamp": jan_1_timestamp}
-            response_with_timestamp = requests.get(base_url, params=params_with_timestamp)
-            if response_with_timestamp.status_code == 200:
-                response_data = response_with_timestamp.json()
-                if "error" in response_data and response_data["error"]["code"] == 5:
-                    # Too many requests error
-                    retry_after = 60  # Default retry time
-                    print(f"[WARNING] Too many requests for user {member_id}. Retrying after {retry_after} seconds...")
-                    time.sleep(retry_after)
-                    member_queue.put(member_id)  # Requeue the member for retry
-                    continue
-                personalstats = response_data.get("personalstats", [])
-                previous_total = next((stat["value"] for stat in personalstats if stat["name"] == "eastereggsfound"), 0)
-            else:
-                print(f"[ERROR] Failed to fetch previous total for user {member_id}: {response_with_timestamp.status_code}")
-                previous_total = 0
-
-            # Fetch stats without the timestamp (current total)
-            params_without_timestamp = {"key": api_key, "stat": "eastereggsfound"}
-            response_without_timestamp = requests.get(base_url, params=params_without_timestamp)
-            if response_without_timestamp.status_code == 200:
-                response_data = response_without_timestamp.json()
-                if "error" in response_data and response_data["error"]["code"] == 5:
-                    # Too many requests error
-                    retry_after = 60  # Default retry time
-                    print(f"[WARNING] Too many requests for user {member_id}. Retrying after {retry_after} seconds...")
-                    time.sleep(retry_after)
-                    member_queue.put(member_id)  # Requeue the member for retry
-                    continue
-                current_total = response_data.get("personalstats", {}).get("items", {}).get("found", {}).get("easter_eggs", 0)
-            else:
-                print(f"[ERROR] Failed to fetch current total for user {member_id}: {response_without_timestamp.status_code}")
-                current_total = 0
-
-            # Calculate the current year's value
-            current_year_value = max(0, current_total - previous_total)  # Ensure no negative values
-
-            # Store the result
-            with results_lock:
-                all_personal_stats[member_id] = {
-                    "name": members.get(member_id, "Unknown"),  # Member name
-                    "faction_name": faction_name,
-                    "current_year_value": current_year_value,
-                    "all_time_total": current_total,
-                }
-            print(f"[INFO] Fetched stats for member {member_id} from faction {faction_name}: Current Year: {current_year_value}, All Time: {current_total}")
+    base_url = f"{BASE_URL}/user/{member_id}/personalstats"
 
+    rate_limit_attempt = 0
+    while True:
+        try:
+            async with sem:
+                api_key = key_manager.get_next_key(faction_id)
+
+                # Fetch stats with the timestamp (previous year's total) unless already cached
+                if member_id in previous_totals:
+                    previous_total = previous_totals[member_id]
+                else:
+                    params_with_timestamp = {"key": api_key, "stat": "eastereggsfound", "timestamp": jan_1_timestamp}
+                    status, response_data = await fetch_json(session, bucket, base_url, params_with_timestamp)
+                    # Torn reports API errors with HTTP 200, so only a real personalstats list is cached
+                    personalstats = response_data.get("personalstats") if status == 200 and "error" not in response_data else None
+                    if isinstance(personalstats, list):
+                        previous_total = eggs(response_data)
+                        previous_totals[member_id] = previous_total
+                    else:
+                        error = response_data.get("error", response_data) if status == 200 else status
+                        logger.error("Failed to fetch previous total for user %s: %s", member_id, error)
+                        return None
+
+                # Fetch stats without the timestamp (current total)
+                params_without_timestamp = {"key": api_key, "stat": "eastereggsfound"}
+                status, response_data = await fetch_json(session, bucket, base_url, params_without_timestamp)
+                if status == 200 and "error" not in response_data:
+                    current_total = eggs(response_data)
+                else:
+                    error = response_data.get("error", response_data) if status == 200 else status
+                    logger.error("Failed to fetch current total for user %s: %s", member_id, error)
+                    return None
+        except RateLimitError as e:
+            retry_after = e.retry_after if e.retry_after is not None else backoff_delay(rate_limit_attempt, BACKOFF_FACTOR)
+            rate_limit_attempt += 1
+            logger.warning("Too many requests for user %s. Retrying after %.1f seconds...", member_id, retry_after)
+            bucket.pause_until(time.monotonic() + retry_after)
+            continue
         except Exception as e:
-            print(f"[ERROR] Error fetching data for user {member_id}: {e}")
-        finally:
-            member_queue.task_done()
-        time.sleep(1.5)  # Default sleep time to avoid hitting the rate limit
+            logger.error("Error fetching data for user %s: %s", member_id, e)
+            return None
+
+        # Calculate the current year's value
+        current_year_value = max(0, current_total - previous_total)  # Ensure no negative values
+
+        logger.info("Fetched stats for member %s from faction %s: Current Year: %s, All Time: %s", member_id, faction_name, current_year_value, current_total)
+        return member_id, {
+            "name": members.get(member_id, "Unknown"),  # Member name
+            "faction_name": faction_name,
+            "current_year_value": current_year_value,
+            "all_time_total": current_total,
+        }
+
+# Function to fetch data for a single faction
+async def process_faction(session, faction_id, faction_data, previous_totals, process_all=True, max_members=10):
+    """
+    Fetch the members of a faction and their personal stats.
+    :param session: The shared aiohttp ClientSession.
+    :param faction_id: The ID of the faction to process.
+    :param faction_data: The faction's entry from the keys file.
+    :param previous_totals: A dictionary of cached January 1st totals keyed by member ID, updated in place.
+    :param process_all: If False, process only the first `max_members` members.
+    :param max_members: The maximum number of members to process when `process_all` is False.
+    :return: A tuple of (personal stats keyed by member ID, True if the faction's members and all of their stats were fetched).
+    """
+    faction_name = faction_data["faction_name"]
+    logger.info("Processing faction: %s (ID: %s)", faction_name, faction_id)
+
+    # One rate limiter and semaphore per faction, shared by all of that faction's API keys
+    bucket = TokenBucket(rate_per_min=RATE_LIMIT_PER_KEY * len(faction_data["keys"]))
+    sem = asyncio.Semaphore(max_concurrency)
+
+    # Fetch faction members; a failure here only skips this faction
+    try:
+        members = await fetch_faction_members(session, bucket, faction_id)
+    except Exception as e:
+        logger.error("Error fetching faction members for faction %s: %s", faction_name, e)
+        return {}, False
+    if not members:
+        return {}, False
+    member_ids = list(members.keys())
+
+    # Limit to the first `max_members` if not processing all
+    if not process_all:
+        member_ids = member_ids[:max_members]
+
+    # Fetch personal stats concurrently, limited by the faction's semaphore
+    logger.info("Fetching personal stats for faction %s...", faction_name)
+    results = await asyncio.gather(*[
+        fetch_member(session, sem, bucket, faction_id, faction_name, member_id, members, previous_totals)
+        for member_id in member_ids
+    ])
+
+    logger.info("Finished processing faction: %s (ID: %s)", faction_name, faction_id)
+    faction_stats = dict(result for result in results if result is not None)
+    return faction_stats, len(faction_stats) == len(member_ids)
 
 # Main function to fetch data for all factions
-def fetch_all_factions(process_all=True, max_members=10):
+async def fetch_all_factions(process_all=True, max_members=10):
     """
-    Fetch data for all factions and their members.
+    Fetch data for all factions and their members. Factions have their own API keys, so they are processed concurrently.
     :param process_all: If True, process all factions and members. If False, process only the first faction and first `max_members` members.
     :param max_members: The maximum number of members to process per faction when `process_all` is False.
+    :return: True if every faction and member was fetched successfully, False if the saved data is partial.
     """
-    with open("faction_keys.json", "r") as f:
-        factions = json.load(f)
+    # Reuse the factions already loaded by the APIKeyManager
+    factions = key_manager.faction_keys
 
     # Limit to the first faction if not processing all
     factions_to_process = factions.items() if process_all else [next(iter(factions.items()))]
 
-    for faction_id, faction_data in factions_to_process:
-        faction_name = faction_data["faction_name"]
-        print(f"[INFO] Processing faction: {faction_name} (ID: {faction_id})")
+    # Load the cached January 1st totals from a previous run, if any
+    previous_totals = {}
+    if os.path.exists(previous_totals_file):
+        logger.info("Loading cached previous totals from %s...", previous_totals_file)
+        with open(previous_totals_file, "rb") as f:
+            previous_totals = orjson.loads(f.read())
+
+    connector = aiohttp.TCPConnector(limit_per_host=CONNECTOR_LIMIT_PER_HOST, keepalive_timeout=KEEPALIVE_TIMEOUT)
+    async with aiohttp.ClientSession(connector=connector, timeout=REQUEST_TIMEOUT, headers=REQUEST_HEADERS) as session:
+        faction_results = await asyncio.gather(*[
+            process_faction(session, faction_id, faction_data, previous_totals, process_all, max_members)
+            for faction_id, faction_data in factions_to_process
+        ])
+
+    # Merge the results from every faction
+    all_personal_stats = {}
+    complete = True
+    for faction_stats, faction_complete in faction_results:
+        all_personal_stats.update(faction_stats)
+        complete = complete and faction_complete
+
+    # Save the previous totals so later runs can skip those requests
+    with open(previous_totals_file, "wb") as f:
+        f.write(orjson.dumps(previous_totals, option=orjson.OPT_INDENT_2))
 
-        # Fetch faction members
-        members = fetch_faction_members(faction_id)
-        member_ids = list(members.keys())
-
-        # Limit to the first `max_members` if not processing all
-        if not process_all:
-            member_ids = member_ids[:max_members]
-
-        for member_id in member_ids:
-            member_queue.put(member_id)
-
-        # Create and start threads for fetching personal stats
-        print(f"[INFO] Starting threads to fetch personal stats for faction {faction_name}...")
-        num_threads = 14  # Adjust based on your system and API limits
-        threads = []
-        for _ in range(num_threads):
-            thread = threading.Thread(target=fetch_personal_stats_worker, args=(faction_id, faction_name, members))
-            thread.start()
-            threads.append(thread)
+    # Save the new stats to a JSON file
+    with open(output_file, "wb") as f:
+        f.write(orjson.dumps(all_personal_stats, option=orjson.OPT_INDENT_2))
 
-        # Wait for all threads to finish
-        for thread in threads:
-            thread.join()
+    logger.info("Data saved to %s", output_file)
+    return complete
 
-        print(f"[INFO] Finished processing faction: {faction_name} (ID: {faction_id})")
+# Header row for the faction CSV files
+CSV_HEADER = ["User ID", "Name", "Faction", "Current Year Value", "All Time Total"]
 
-    # Save the new stats to a JSON file
-    with open(output_file, "w") as f:
-        json.dump(all_personal_stats, f, indent=4)
+# Number of users shown in each faction's Discord table
+DISCORD_TOP_N = 20
 
-    print(f"[INFO] Data saved to {output_file}")
+# Function to write faction CSV files in the background (thread worker)
+def write_csv_worker(csv_queue, saved_files):
+    """
+    Worker function that writes faction CSV files until it receives None.
+    Rows are sorted by current year value (index 3) in descending order before writing.
+    :param csv_queue: A queue of (faction name, CSV file path, rows) tuples, where rows excludes the header.
+    :param saved_files: A list that (faction name, CSV file path) is appended to for each file written,
+        so the caller can report them after the Discord tables instead of in between.
+    """
+    while True:
+        item = csv_queue.get()
+        if item is None:
+            break
+        faction_name, faction_csv_file, rows = item
+        try:
+            with open(faction_csv_file, "w", newline="", buffering=1 << 20) as csvfile:
+                writer = csv.writer(csvfile)
+                writer.writerow(CSV_HEADER)
+                writer.writerows(sorted(rows, key=lambda x: x[3], reverse=True))
+            saved_files.append((faction_name, faction_csv_file))
+        except Exception as e:
+            logger.error("Failed to save scores for faction '%s': %s", faction_name, e)
 
 # New functionality: Extract Easter Egg Hunt scores and save to separate CSV files for each faction
 def extract_easter_egg_hunt_scores(input_file, output_dir):
@@ -177,59 +343,86 @@ def extract_easter_egg_hunt_scores(input_file, output_dir):
     :param input_file: The JSON file containing user data.
     :param output_dir: The directory where faction-specific CSV files will be saved.
     """
-    print("[INFO] Extracting and sorting Easter Egg Hunt scores...")
-    try:
-        with open(input_file, "r") as f:
-            data = json.load(f)
+    logger.info("Extracting and sorting Easter Egg Hunt scores...")
+
+    # Start a single writer thread so sorting and printing never wait on disk
+    csv_queue = Queue()
+    saved_files = []
+    writer_thread = threading.Thread(target=write_csv_worker, args=(csv_queue, saved_files))
+    writer_thread.start()
 
+    try:
         # Prepare data grouped by faction
         faction_data = {}
 
-        # Collect and group data by faction
-        for user_id, user_data in data.items():
-            name = user_data.get("name", "Unknown")
-            faction_name = user_data.get("faction_name", "Unknown")
-            current_year_value = user_data.get("current_year_value", 0)
-            all_time_total = user_data.get("all_time_total", 0)
+        # Stream the users one at a time and group them by faction
+        with open(input_file, "rb") as f:
+            for user_id, user_data in ijson.kvitems(f, ""):
+                name = user_data.get("name", "Unknown")
+                faction_name = user_data.get("faction_name", "Unknown")
+                current_year_value = user_data.get("current_year_value", 0)
+                all_time_total = user_data.get("all_time_total", 0)
 
-            if faction_name not in faction_data:
-                faction_data[faction_name] = []
+                if faction_name not in faction_data:
+                    faction_data[faction_name] = []
 
-            faction_data[faction_name].append((user_id, name, faction_name, current_year_value, all_time_total))
+                faction_data[faction_name].append((user_id, name, faction_name, current_year_value, all_time_total))
 
         # Ensure output directory exists
         os.makedirs(output_dir, exist_ok=True)
 
         # Process each faction's data
         for faction_name, users in faction_data.items():
-            # Sort the data by current year value (index 3) in descending order
-            users.sort(key=lambda x: x[3], reverse=True)
-
-            # Prepare CSV data and Discord table
-            csv_data = [["User ID", "Name", "Faction", "Current Year Value", "All Time Total"]]
-            discord_table = "| User ID | Name            | Faction               | Current Year Value | All Time Total |\n"
-            discord_table += "|---------|-----------------|-----------------------|--------------------|----------------|\n"
-
-            for user_id, name, faction_name, current_year_value, all_time_total in users:
-                csv_data.append([user_id, name, faction_name, current_year_value, all_time_total])
-                discord_table += f"| {user_id:<7} | {name:<15} | {faction_name:<21} | {current_year_value:<18} | {all_time_total:<14} |\n"
-
-            # Write to faction-specific CSV file
+            # Hand the faction-specific CSV file to the writer thread, which sorts the full list;
+            # the user tuples are already CSV rows
             faction_csv_file = os.path.join(output_dir, f"{faction_name.replace(' ', '_')}_scores.csv")
-            with open(faction_csv_file, "w", newline="") as csvfile:
-                writer = csv.writer(csvfile)
-                writer.writerows(csv_data)
+            csv_queue.put((faction_name, faction_csv_file, users))
 
-            print(f"[INFO] Scores for faction '{faction_name}' saved to {faction_csv_file}.")
-            print(f"[INFO] Discord Table for faction '{faction_name}':\n")
-            print(discord_table)
+            # Only the top users by current year value (index 3) go in the Discord table
+            top_users = heapq.nlargest(DISCORD_TOP_N, users, key=lambda x: x[3])
 
-    except Exception as e:
-        print(f"[ERROR] Failed to extract and sort Easter Egg Hunt scores: {e}")
+            # Build the Discord table in one join rather than repeated concatenation
+            discord_table = (
+                "| User ID | Name            | Faction               | Current Year Value | All Time Total |\n"
+                "|---------|-----------------|-----------------------|--------------------|----------------|\n"
+                + "".join(
+                    f"| {user_id:<7} | {name:<15} | {user_faction:<21} | {current_year_value:<18} | {all_time_total:<14} |\n"
+                    for user_id, name, user_faction, current_year_value, all_time_total in top_users
+                )
+            )
 
-# Fetch data for all factions
-fetch_all_factions()
+            logger.info("Discord Table for faction '%s' (top %s):\n\n%s", faction_name, DISCORD_TOP_N, discord_table)
 
-# Extract scores and save to separate CSV files for each faction
-extract_easter_egg_hunt_scores(output_file, "faction_scores")
+    except Exception as e:
+        logger.error("Failed to extract and sort Easter Egg Hunt scores: %s", e)
+    finally:
+        # Stop the writer thread once every queued file has been written
+        csv_queue.put(None)
+        writer_thread.join()
+
+    for faction_name, faction_csv_file in saved_files:
+        logger.info("Scores for faction '%s' saved to %s.", faction_name, faction_csv_file)
+
+# All output goes through the logger so it comes out in the order it was produced
+try:
+    # Fetch data for all factions, unless today's data was fetched within the last hour
+    if os.path.exists(cache_file) and time.time() - os.path.getmtime(cache_file) < CACHE_MAX_AGE:
+        logger.info("%s is less than an hour old. Skipping the API and using cached data...", cache_file)
+        input_file = cache_file
+    elif asyncio.run(fetch_all_factions()):
+        # Only a complete fetch refreshes the cache; older daily copies are removed
+        shutil.copyfile(output_file, cache_file)
+        for old_cache_file in glob.glob("user_profile_data_*.json"):
+            if old_cache_file != cache_file:
+                os.remove(old_cache_file)
+        input_file = cache_file
+    else:
+        logger.warning("Some factions or members could not be fetched. Not updating %s.", cache_file)
+        input_file = output_file
+
+    # Extract scores and save to separate CSV files for each faction
+    extract_easter_egg_hunt_scores(input_file, "faction_scores")
+finally:
+    # Flush any queued log messages before exiting, even if the run failed
+    log_listener.stop()
 
@@ -0,0 +1,12 @@
+def eggs(stats):
+    """
+    Get the easter egg count from a personalstats response.
+    Handles both the `stat=eastereggsfound` shape (a list of {name, value})
+    and the nested `cat=all` shape (personalstats.items.found.easter_eggs).
+    :param stats: The personalstats response for a member.
+    :return: The number of easter eggs found.
+    """
+    personalstats = stats.get("personalstats", {})
+    if isinstance(personalstats, list):
+        return next((stat["value"] for stat in personalstats if stat["name"] == "eastereggsfound"), 0)
+    return personalstats.get("items", {}).get("found", {}).get("easter_eggs", 0)
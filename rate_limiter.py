@@ -0,0 +1,89 @@
+import asyncio
+import random
+import threading
+import time
+
+class TokenBucket:
+    def __init__(self, rate_per_min=100, burst=10):
+        """
+        Initialize a token bucket that refills at a fixed rate per minute.
+        :param rate_per_min: The number of requests allowed per minute.
+        :param burst: The maximum number of tokens that can be saved up.
+        """
+        self.rate = rate_per_min / 60.0
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last_refill = time.monotonic()
+        self.paused_until = 0.0
+        self.condition = threading.Condition()
+
+    def _try_take(self):
+        """
+        Refill the bucket and take a token if one is available. Must be called with the condition held.
+        :return: 0 if a token was taken, otherwise the number of seconds to wait before trying again.
+        """
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        """
+        Block the calling thread until a token is available.
+        """
+        with self.condition:
+            wait = self._try_take()
+            while wait > 0:
+                self.condition.wait(wait)
+                wait = self._try_take()
+
+    async def acquire_async(self):
+        """
+        Wait without blocking the event loop until a token is available.
+        """
+        while True:
+            with self.condition:
+                wait = self._try_take()
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+    def pause_until(self, deadline):
+        """
+        Stop handing out tokens until the given time, e.g. when the API reports a rate limit.
+        :param deadline: A time.monotonic() value at which requests may resume.
+        """
+        with self.condition:
+            self.paused_until = max(self.paused_until, deadline)
+            self.tokens = 0
+            self.last_refill = self.paused_until
+            self.condition.notify_all()
+
+def backoff_delay(attempt, backoff_factor=0.5, max_delay=60):
+    """
+    Get an exponential backoff delay with jitter, so retrying callers don't all wake up at once.
+    :param attempt: The number of retries made so far, starting at 0.
+    :param backoff_factor: The base delay in seconds, doubled on every attempt.
+    :param max_delay: The longest delay in seconds before jitter is applied.
+    :return: The number of seconds to wait, between half and all of the exponential delay.
+    """
+    delay = min(max_delay, backoff_factor * (2 ** attempt))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+def get_retry_after(headers, default=None):
+    """
+    Read the Retry-After header of a response.
+    :param headers: The response headers.
+    :param default: The value to return if the header is missing or not a number of seconds.
+    :return: The number of seconds to wait, or `default`.
+    """
+    try:
+        return float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return default